@@ -1,21 +1,29 @@
 import math
-import numpy
 import heapq
+import random
+from array import array
 
 # a data container for all pertinent information related to fares. (Should we
 # add an underway flag and require taxis to acknowledge collection to the dispatcher?)
 class FareEntry:
 
-      def __init__(self, origin, dest, time, price=0, taxiIndex=-1):
+      # a fixed set of attributes: one of these is created for every fare, and they're read in the
+      # dispatcher's inner loops, so there's no need for a per-instance __dict__
+      __slots__ = ('origin', 'destination', 'calltime', 'price', 'taxi', 'bidders', 'originNode', 'destNode')
+
+      def __init__(self, origin, dest, time, price=0, taxiIndex=-1, originNode=None, destNode=None):
 
           self.origin = origin
           self.destination = dest
+          # the world's Nodes at origin and destination, resolved once when the fare is created
+          self.originNode = originNode
+          self.destNode = destNode
           self.calltime = time
           self.price = price
           # the taxi allocated to service this fare. -1 if none has been allocated
           self.taxi = taxiIndex
-          # a list of indices of taxis that have bid on the fare.
-          self.bidders = []
+          # the indices of taxis that have bid on the fare, packed as C ints.
+          self.bidders = array('i')
 
 '''
 A Dispatcher is a static agent whose job is to allocate fares amongst available taxis. Like the taxis, all
@@ -38,21 +46,39 @@ class Dispatcher:
           self._taxis = taxis
           if self._taxis is None:
              self._taxis = []
-          # fareBoard will be a nested dictionary indexed by origin, then destination, then call time.
-          # Its values are FareEntries. The nesting structure provides for reasonably fast lookup; it's
-          # more or less a multi-level hash.
+          # reverse lookup from taxi to its index in the list, kept in step with it
+          self._taxiIdx = {taxi: idx for idx, taxi in enumerate(self._taxis)}
+          # fareBoard is a flat dictionary indexed by an (origin, destination, call time) triplet.
+          # Its values are FareEntries. A single hash on the whole key is cheaper than walking
+          # a nested dictionary one level at a time.
           self._fareBoard = {}
+          # only one fare per origin can be open for bids at a time. This indexes that fare by its
+          # origin, so that bids go straight to it; fares leave it once allocated or cancelled.
+          self._openByOrigin = {}
+          # heap queues of (call time, origin, destination) keys into the fareBoard, oldest first:
+          # fares still waiting for a price, and fares with bids waiting to be allocated. Entries
+          # are not removed when a fare cancels; clockTick simply discards any it can't find.
+          self._uncosted = []
+          self._pendingAlloc = []
+          # the pendingAlloc entries that are still live: fares with bids that have not been allocated
+          # or cancelled since. Lets clockTick discard dead entries without going to the fareBoard.
+          self._readyForAlloc = set()
           # serviceMap gives the dispatcher its service area
           self._map = serviceMap
           # Amount of cancelled fares
           self._cancelled = 0
+          # per-tick caches of node lookups and travel times between nodes. Travel times depend on
+          # traffic, so both are only valid for the tick in which they were filled.
+          self._nodeCache = {}
+          self._ttCache = {}
 
       #_________________________________________________________________________________________________________
       # methods to add objects to the Dispatcher's knowledge base
       
       # make a new taxi known.
       def addTaxi(self, taxi):
-          if taxi not in self._taxis:
+          if taxi not in self._taxiIdx:
+             self._taxiIdx[taxi] = len(self._taxis)
              self._taxis.append(taxi)
 
       # incrementally add to the map. This can be useful if, e.g. the world itself has a set of
@@ -93,12 +119,12 @@ class Dispatcher:
           if self._parent == parent:
              # handover implies taxis definitely known to a previous dispatcher. The current
              # dispatcher should thus be made aware of them
-             if taxi not in self._taxis:
-                self._taxis.append(taxi)
+             self.addTaxi(taxi)
              # add any fares found along with their allocations
              self.newFare(parent, origin, destination, time)
-             self._fareBoard[origin][destination][time].taxi = self._taxis.index(taxi)
-             self._fareBoard[origin][destination][time].price = price
+             self._fareBoard[(origin,destination,time)].taxi = self._taxiIdx[taxi]
+             self._fareBoard[(origin,destination,time)].price = price
+             self._closeFare(self._fareBoard[(origin,destination,time)])
 
       #--------------------------------------------------------------------------------------------------------------
       # runtime methods used to inform the Dispatcher of real-time events
@@ -108,48 +134,50 @@ class Dispatcher:
       def newFare(self, parent, origin, destination, time):
           # only add new fares coming from the same world
           if parent == self._parent:
-             fare = FareEntry(origin,destination,time)
-             if origin in self._fareBoard:               
-                if destination not in self._fareBoard[origin]:
-                   self._fareBoard[origin][destination] = {}
-             else:
-                self._fareBoard[origin] = {destination: {}}
+             fare = FareEntry(origin,destination,time,
+                              originNode=parent.getNode(origin[0],origin[1]),
+                              destNode=parent.getNode(destination[0],destination[1]))
              # overwrites any existing fare with the same (origin, destination, calltime) triplet, but
              # this would be equivalent to saying it was the same fare, at least in this world where
-             # a given Node only has one fare at a time.
-             self._fareBoard[origin][destination][time] = fare
+             # a given Node only has one fare at a time. The replacement is unpriced, so it always
+             # needs queueing; clockTick skips any duplicate entry once the fare has a price.
+             self._fareBoard[(origin,destination,time)] = fare
+             self._openByOrigin[origin] = fare
+             # a replaced fare takes its bids with it
+             self._readyForAlloc.discard((time,origin,destination))
+             heapq.heappush(self._uncosted, (time,origin,destination))
              
       # abandoning fares will call this to cancel their request
       def cancelFare(self, parent, origin, destination, calltime):
-          # if the fare exists in our world,
-          if parent == self._parent and origin in self._fareBoard:
-             if destination in self._fareBoard[origin]:
-                if calltime in self._fareBoard[origin][destination]:
-                   # get rid of it
-                   print("Fare ({0},{1}) cancelled".format(origin[0],origin[1]))
-                   self._cancelled += 1
-                   # inform taxis that the fare abandoned
-                   self._parent.cancelFare(origin, self._taxis[self._fareBoard[origin][destination][calltime].taxi])
-                   del self._fareBoard[origin][destination][calltime]
-                if len(self._fareBoard[origin][destination]) == 0:
-                   del self._fareBoard[origin][destination]
-                if len(self._fareBoard[origin]) == 0:
-                   del self._fareBoard[origin]
+          if parent != self._parent:
+             return
+          # if the fare exists in our world, get rid of it
+          fare = self._fareBoard.pop((origin,destination,calltime), None)
+          if fare is None:
+             return
+          print("Fare ({0},{1}) cancelled".format(origin[0],origin[1]))
+          self._cancelled += 1
+          # inform taxis that the fare abandoned
+          self._parent.cancelFare(origin, self._taxis[fare.taxi])
+          self._closeFare(fare)
+
+      # stops a fare taking any more bids, leaving alone any newer fare that has since called from the same origin
+      def _closeFare(self, fare):
+          if self._openByOrigin.get(fare.origin) is fare:
+             del self._openByOrigin[fare.origin]
+          self._readyForAlloc.discard((fare.calltime,fare.origin,fare.destination))
 
       # taxis register their bids for a fare using this mechanism
       def fareBid(self, origin, taxi):
           # rogue taxis (not known to the dispatcher) can't bid on fares
-          if taxi in self._taxis:
-             # everyone else bids on fares available
-             if origin in self._fareBoard:
-                for destination in self._fareBoard[origin].keys():
-                    for time in self._fareBoard[origin][destination].keys():
-                        # as long as they haven't already been allocated
-                        if self._fareBoard[origin][destination][time].taxi == -1:
-                           self._fareBoard[origin][destination][time].bidders.append(self._taxis.index(taxi))
-                           # only one fare per origin can be actively open for bid, so
-                           # immediately return once we[ve found it
-                           return
+          # everyone else bids on the fare open at that origin, if there is one
+          fare = self._openByOrigin.get(origin)
+          if fare is not None and taxi in self._taxiIdx:
+             fare.bidders.append(self._taxiIdx[taxi])
+             # the first bid makes the fare a candidate for allocation
+             if len(fare.bidders) == 1:
+                heapq.heappush(self._pendingAlloc, (fare.calltime,origin,fare.destination))
+                self._readyForAlloc.add((fare.calltime,origin,fare.destination))
                      
       # fares call this (through the parent world) when they have reached their destination
       def recvPayment(self, parent, amount):
@@ -164,81 +192,120 @@ class Dispatcher:
       # allocateFare(origin, taxi).
       def clockTick(self, parent):
           if self._parent == parent:
-             for origin in self._fareBoard.keys():
-                 for destination in self._fareBoard[origin].keys():
-                     # TODO - if you can come up with something better. Not essential though.
-                     # not super-efficient here: need times in order, dictionary view objects are not
-                     # sortable because they are an iterator, so we need to turn the times into a
-                     # sorted list. Hopefully fareBoard will never be too big
-                     for time in sorted(list(self._fareBoard[origin][destination].keys())):
-                         if self._fareBoard[origin][destination][time].price == 0:
-                            self._fareBoard[origin][destination][time].price = self._costFare(self._fareBoard[origin][destination][time])
-                            # broadcastFare actually returns the number of taxis that got the info, if you
-                            # wish to use that information in the decision over when to allocate
-                            self._parent.broadcastFare(origin,
-                                                       destination,
-                                                       self._fareBoard[origin][destination][time].price)
-                         elif self._fareBoard[origin][destination][time].taxi < 0 and len(self._fareBoard[origin][destination][time].bidders) > 0:
-                              self._allocateFare(origin, destination, time)
+             # the loops below run every tick, so look everything they need up once, here
+             board = self._fareBoard
+             uncosted = self._uncosted
+             pendingAlloc = self._pendingAlloc
+             ready = self._readyForAlloc
+             now = parent.simTime
+             pop = heapq.heappop
+             # clear out fares at the front of the allocation queue that were allocated or cancelled
+             # after they were bid on
+             while len(pendingAlloc) > 0 and pendingAlloc[0] not in ready:
+                   pop(pendingAlloc)
+             # most ticks in a sparse world have nothing new to price and nothing due for allocation,
+             # so return before doing any work at all
+             if len(uncosted) == 0 and (len(pendingAlloc) == 0 or now-pendingAlloc[0][0] <= 3):
+                return
+             self._nodeCache = {}
+             self._ttCache = {}
+             alloc = self._allocateFare
+             broadcast = parent.broadcastFare
+             # the heap queues keep fares in call-time order, so there is no need to sort the
+             # fareBoard. First gather any new fares,
+             newFares = []
+             while len(uncosted) > 0:
+                   time, origin, destination = pop(uncosted)
+                   fare = board.get((origin,destination,time))
+                   # skipping any that have since cancelled or were handed over already priced
+                   if fare is None or fare.price != 0:
+                      continue
+                   newFares.append(fare)
+             # then price them all together, and announce them
+             if len(newFares) > 0:
+                for fare, price in zip(newFares, self._costFares(newFares)):
+                    fare.price = price
+                    # broadcastFare actually returns the number of taxis that got the info, if you
+                    # wish to use that information in the decision over when to allocate
+                    broadcast(fare.origin, fare.destination, fare.price)
+             # then allocate fares that have bids, once taxis have had their 3 ticks to respond
+             while len(pendingAlloc) > 0 and now-pendingAlloc[0][0] > 3:
+                   entry = pop(pendingAlloc)
+                   if entry not in ready:
+                      continue
+                   ready.discard(entry)
+                   alloc(entry[1], entry[2], entry[0])
+
+      # memoised lookups into the world, valid for the current tick only (see clockTick)
+      def _getNode(self, coords):
+          if coords not in self._nodeCache:
+             self._nodeCache[coords] = self._parent.getNode(coords[0],coords[1])
+          return self._nodeCache[coords]
+
+      def _tt(self, nodeA, nodeB):
+          if (nodeA,nodeB) not in self._ttCache:
+             self._ttCache[(nodeA,nodeB)] = self._parent.travelTime(nodeA,nodeB)
+          return self._ttCache[(nodeA,nodeB)]
 
       #----------------------------------------------------------------------------------------------------------------
 
       ''' HERE IS THE PART THAT YOU NEED TO MODIFY
       '''
 
-      '''this internal method should decide a 'reasonable' cost for the fare. Here, the computation
+      '''this internal method should decide a 'reasonable' cost for each of the fares. Here, the computation
          is trivial: add a fixed cost (representing a presumed travel time to the fare by a given
          taxi) then multiply the expected travel time by the profit-sharing ratio. Better methods
          should improve the expected number of bids and expected profits. The function gets all the
          fare information, even though currently it's not using all of it, because you may wish to
-         take into account other details.
+         take into account other details. All the new fares in a tick are priced together, since
+         what the taxis are doing doesn't change between them.
       '''
       # TODO - improve costing
-      def _costFare(self, fare):
-          # Calculate time of fare
-          timeToDestination = self._parent.travelTime(self._parent.getNode(fare.origin[0],fare.origin[1]),
-                                                      self._parent.getNode(fare.destination[0],fare.destination[1]))
-
-          # if the world is gridlocked, a flat fare applies.
-          if timeToDestination < 0:
-              return 150
-          available = []
-          total_times = []
-          # Base payment
-          result = 10
+      def _costFares(self, fares):
+          getNode = self._getNode
+          tt = self._tt
+          available = 0
+          # for each taxi that has an expected time, the time it needs before it could start on a new fare
+          base_times = []
           # Iterate through taxi list
           for taxi in self._taxis:
               # Check if any taxis are available and if so how long remains on current fares and allocated fares
-              current_allocations = [fare for fare in taxi._availableFares.values() if fare.allocated]
-              if len(current_allocations) < 2:
-                  available.append(taxi)
+              nAlloc = len(taxi._allocatedFares)
+              if nAlloc < 2:
+                  available += 1
               if taxi._passenger:
-                  if len(current_allocations) == 1:
-                      current = self._parent.travelTime(taxi._loc, self._parent.getNode(taxi._path[0][0], taxi._path[0][1]))
-                      current += timeToDestination
-                      total_times.append(current)
-
-                  elif len(current_allocations) == 2:
-                          current = self._parent.travelTime(taxi._loc, self._parent.getNode(taxi._path[0][0],taxi._path[0][1]))
-                          next_node = self._parent.getNode(current_allocations[1].destination[0], current_allocations[1].destination[1])
-                          next = self._parent.travelTime(self._parent.getNode(taxi._path[0][0],taxi._path[0][1]),
-                                                         next_node)
-                          current += timeToDestination + next
-
-                          total_times.append(current)
+                  if nAlloc == 1:
+                      base_times.append(tt(taxi._loc, getNode(taxi._path[0])))
+
+                  elif nAlloc == 2:
+                          current = tt(taxi._loc, getNode(taxi._path[0]))
+                          # the second allocated fare in the order the taxi was advised of them. This branch
+                          # is rare, so scanning availableFares here is cheaper than keeping them ordered.
+                          second = [info for info in taxi._availableFares.values() if info.allocated][1]
+                          next_node = getNode(second.destination)
+                          next = tt(getNode(taxi._path[0]), next_node)
+                          base_times.append(current + next)
               else:
-                  total_times.append((timeToDestination))
-          # Large price if no taxis have less than 2 allocations
-          if len(available) < 2:
-              return 150
-          # Increase fare price if taxis are large distance from fare
-          for time in total_times:
-              if time > timeToDestination*2:
-                  result += 7
-          # Get number of expected bids and increase price between 10 and 15 depending on number of bids expected
-          expected_bids = numpy.random.randint(len(available), size=1)
-          result+=timeToDestination+(numpy.random.randint(10,15,size=1)*expected_bids)
-          return result[0]
+                  base_times.append(0)
+          prices = []
+          for fare in fares:
+              # Calculate time of fare
+              timeToDestination = tt(fare.originNode, fare.destNode)
+              # if the world is gridlocked, or no more than one taxi has less than 2 allocations, a flat fare applies.
+              if timeToDestination < 0 or available < 2:
+                  prices.append(150)
+                  continue
+              # Get number of expected bids and increase price between 10 and 15 depending on number of bids expected
+              expected_bids = random.randrange(available)
+              premium = random.randint(10,14)*expected_bids
+              # Increase fare price if taxis are large distance from fare: a taxi's expected time is its
+              # base time plus the fare's, so it takes more than twice as long if its base time is longer
+              slow = 0
+              for base in base_times:
+                  if base > timeToDestination:
+                      slow += 1
+              prices.append(10+7*slow+timeToDestination+premium)
+          return prices
 
           """timeToDestination = self._parent.travelTime(self._parent.getNode(fare.origin[0], fare.origin[1]),
                                                       self._parent.getNode(fare.destination[0], fare.destination[1]))
@@ -253,25 +320,24 @@ class Dispatcher:
       # action. You should be able to do better than that using some form of CSP solver (this is just a suggestion,
       # other methods are also acceptable and welcome).
       def _allocateFare(self, origin, destination, time):
-          # Dict to hold domains
-          vari = {}
+          fare = self._fareBoard[(origin,destination,time)]
           # Taxis have 3 ticks to respond
           if self._parent.simTime-time > 3:
-              # Add bidders to dictionary with domain of allocate or not
-              for taxiIdx in self._fareBoard[origin][destination][time].bidders:
-                  if len(self._taxis) > taxiIdx:
-                      vari[taxiIdx] = ["allocate", "no"]
+              # Each bidder's domain is allocate (True) or not (False); all start out as candidates
+              candidate = {taxiIdx: True for taxiIdx in fare.bidders if len(self._taxis) > taxiIdx}
               # Check if at least 1 bidders
-              if len(vari) >= 1:
+              if len(candidate) >= 1:
                   # If there are taxis without allocations, only allocate to these
-                  vari =  self.testFree(self._fareBoard[origin][destination][time].bidders, vari)
+                  candidate = self.testFree(candidate)
                   # Decide on the allocation based on distance to finishing current fare and distance from origin of fare
-                  vari = self.testDist(destination, self._fareBoard[origin][destination][time].bidders, vari)
+                  candidate = self.testDist(fare.destNode, candidate)
                   # Allocate fare to winner
-                  for key, value in vari.items():
-                      if "allocate" in value:
-                          self._fareBoard[origin][destination][time].taxi = key
-                          self._parent.allocateFare(origin, self._taxis[key])
+                  for taxiIdx, ok in candidate.items():
+                      if ok:
+                          fare.taxi = taxiIdx
+                          self._closeFare(fare)
+                          self._parent.allocateFare(origin, self._taxis[taxiIdx])
+                          break
 
 
           # Variables are the taxis
@@ -295,7 +361,7 @@ class Dispatcher:
              # 3) that the taxi's location is 'on-grid': somewhere in the dispatcher's map
              # 4) that at least one valid taxi has actually bid on the fare
              if fareNode is not None:
-                for taxiIdx in self._fareBoard[origin][destination][time].bidders:
+                for taxiIdx in self._fareBoard[(origin,destination,time)].bidders:
                     if len(self._taxis) > taxiIdx:
                        bidderLoc = self._taxis[taxiIdx].currentLocation
                        bidderNode = self._parent.getNode(bidderLoc[0],bidderLoc[1])
@@ -310,59 +376,38 @@ class Dispatcher:
                              # the auction may have occurred.
                              if allocatedTaxi >= 0:
                                 # but if so, allocate the taxi.
-                                self._fareBoard[origin][destination][time].taxi = allocatedTaxi     
+                                self._fareBoard[(origin,destination,time)].taxi = allocatedTaxi     
                                 self._parent.allocateFare(origin,self._taxis[allocatedTaxi])"""
 
-      def testFree(self, taxis, vari):
-          # List of taxis with no passengers
-          free = []
-          for taxiIdx in taxis:
-              if self._taxis[taxiIdx]._passenger == None:
-                  free.append(taxiIdx)
-          # Check if at least 1 taxi is free
+      def testFree(self, candidate):
+          # Set of taxis with no passengers
+          free = {taxiIdx for taxiIdx in candidate if self._taxis[taxiIdx]._passenger is None}
+          # Check if at least 1 taxi is free, and if so do not allow allocations to taxis which are not
           if len(free)>=1:
-              for taxiIdx in taxis:
-                  # Do not allow allocations to taxis which are not free
-                  if taxiIdx not in free:
-                      vari[taxiIdx].remove("allocate")
-          return vari
+              candidate = {taxiIdx: taxiIdx in free for taxiIdx in candidate}
+          return candidate
 
-      def testDist(self, destination, taxis, vari):
+      def testDist(self, dest, candidate):
+          # dest is the new fare's destination Node
           distances = {}
-          # Store destination of new fare
-          dest = self._parent.getNode(destination[0],destination[1])
           #Calculate distances based on if current fare in progress
-          for taxiIdx in taxis:
+          for taxiIdx, ok in candidate.items():
               # Check if taxi can be allocated to
-              if "allocate" in vari[taxiIdx]:
-                  # Get current taxi location and node
-                current = self._taxis[taxiIdx].currentLocation
-                currentNode = self._parent.getNode(current[0], current[1])
-                # Check if taxi is currently on a fare
-                if self._taxis[taxiIdx]._passenger:
-                    # Get current destination node
-                    dropoff = self._taxis[taxiIdx]._path[-1]
-                    dropoffNode = self._parent.getNode(dropoff[0], dropoff[1])
-                    # Calculate distance to destination plus new fare location
-                    distances[taxiIdx] = self._parent.travelTime(currentNode, dropoffNode) + self._parent.travelTime(dropoffNode,dest)
-                # If no current fare then calculate distance from current location to fare
-                else:
-                    distances[taxiIdx] = self._parent.travelTime(currentNode,dest)
-          # Store lowest ID and distance
-          lowest = []
-          # iterate through distances to append lowest distance and taxiID
-          for key, value in distances.items():
-              if not lowest:
-                  lowest.append(key)
-                  lowest.append(value)
+              if not ok:
+                  continue
+              taxi = self._taxis[taxiIdx]
+              # Get current taxi node
+              currentNode = self._getNode(taxi.currentLocation)
+              # Check if taxi is currently on a fare (with somewhere left to go)
+              if taxi._passenger and len(taxi._path) > 0:
+                  # Get current destination node
+                  dropoffNode = self._getNode(taxi._path[-1])
+                  # Calculate distance to destination plus new fare location
+                  distances[taxiIdx] = self._tt(currentNode, dropoffNode) + self._tt(dropoffNode, dest)
+              # If no current fare then calculate distance from current location to fare
               else:
-                  if value < lowest[1]:
-                      lowest[0] = key
-                      lowest[1] = value
-          # Remove allocation to all except lowest distance
-          for taxiIdx in taxis:
-              if taxiIdx != lowest[0]:
-                  if "allocate" in vari[taxiIdx]:
-                    vari[taxiIdx].remove("allocate")
-          return vari
+                  distances[taxiIdx] = self._tt(currentNode, dest)
+          # Only the taxi with the lowest distance remains a candidate
+          winner = min(distances, key=distances.get)
+          return {winner: True}
      
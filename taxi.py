@@ -106,6 +106,9 @@ class Taxi:
           # the dictionary items, meanwhile, contain a FareInfo object with the price, the destination, and whether 
           # or not this taxi has been allocated the fare (and thus should proceed to collect them ASAP from the origin)
           self._availableFares = {}
+          # the subset of availableFares that have been allocated to this taxi, under the same keys, so
+          # that the dispatcher can see how committed the taxi is without scanning every fare.
+          self._allocatedFares = {}
 
       # This property allows the dispatcher to query the taxi's location directly. It's like having a GPS transponder
       # in each taxi.
@@ -226,6 +229,7 @@ class Taxi:
                        fare[1].bid = -1
              for expired in faresToRemove:
                  del self._availableFares[expired]
+                 self._allocatedFares.pop(expired, None)
           # may want to do something active whilst enroute - this simple default version does
           # nothing, but that is probably not particularly 'intelligent' behaviour.
           else:
@@ -293,6 +297,7 @@ class Taxi:
           if msg == self.FARE_ADVICE:
              callTime = self._world.simTime
              self._availableFares[callTime,args['origin'][0],args['origin'][1]] = FareInfo(args['destination'],args['price'])
+             self._allocatedFares.pop((callTime,args['origin'][0],args['origin'][1]), None)
              return
           # the dispatcher has approved our bid: mark the fare as ours
           elif msg == self.FARE_ALLOC:
@@ -300,6 +305,7 @@ class Taxi:
                  if fare[0][1] == args['origin'][0] and fare[0][2] == args['origin'][1]:
                     if fare[1].destination[0] == args['destination'][0] and fare[1].destination[1] == args['destination'][1]:
                        fare[1].allocated = True
+                       self._allocatedFares[fare[0]] = fare[1]
                        return
           # we just dropped off a fare and received payment, add it to the account
           elif msg == self.FARE_PAY:
@@ -312,6 +318,7 @@ class Taxi:
              for fare in self._availableFares.items():
                  if fare[0][1] == args['origin'][0] and fare[0][2] == args['origin'][1]: # and fare[1].allocated: 
                     del self._availableFares[fare[0]]
+                    self._allocatedFares.pop(fare[0], None)
                     return
       #_____________________________________________________________________________________________________________________
 